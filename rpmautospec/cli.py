@@ -49,7 +49,9 @@ def get_arg_parser() -> CustomArgumentParser:
     parser = CustomArgumentParser(
         prog="rpmautospec",
         epilog="Environment variable $RPMAUTOSPEC_LESS can specify pager options"
-        " (pager is currently only used by 'generate-changelog').",
+        " (pager is currently only used by 'generate-changelog'). Setting"
+        " $RPMAUTOSPEC_VERFLAGS_CACHE to 1 caches information parsed from historical spec files"
+        " in the git directory of packages.",
     )
 
     # global arguments
@@ -1,24 +1,56 @@
 import datetime as dt
+import hashlib
+import io
 import logging
+import os
 import re
+import shelve
 import subprocess
 import sys
+import weakref
 from collections import defaultdict
-from functools import reduce
+from contextlib import contextmanager, ExitStack
+from functools import cached_property, reduce
 from pathlib import Path
-from shutil import SpecialFileError
-from tempfile import NamedTemporaryFile, TemporaryDirectory
-from typing import Any, Optional, Sequence, Union
+from shutil import rmtree, SpecialFileError
+from tempfile import mkdtemp, TemporaryFile
+from typing import Any, Callable, IO, NamedTuple, Optional, Sequence, Union
 
 import pygit2
 from rpmautospec_core import AUTORELEASE_MACRO
 
+try:
+    import rpm
+
+    # Guard against picking up something else called `rpm`, e.g. the directory containing the RPM
+    # macros file if run from a source checkout.
+    rpm.spec
+except (ImportError, AttributeError):
+    rpm = None
+
 from .changelog import ChangelogEntry
 
 
 log = logging.getLogger(__name__)
 
 
+class Visitor(NamedTuple):
+    """A visitor processing commits in two halves.
+
+    When walking the history from new to old commits, the top half (`pre`)
+    gets the (merged) information from child commits and returns
+    information for its parents, e.g. whether they must be processed, and
+    state to be passed on to the bottom half.
+
+    Afterwards, the bottom half (`post`) is called in the opposite order with
+    that state, the partial result for the commit and the results of its
+    parents and returns the (amended) result for the commit.
+    """
+
+    pre: Callable[[pygit2.Commit, dict[str, Any]], tuple[dict[str, Any], Any]]
+    post: Callable[[pygit2.Commit, Any, dict[str, Any], list[dict[str, Any]]], dict[str, Any]]
+
+
 class PkgHistoryProcessor:
 
     autorelease_flags_re = re.compile(
@@ -27,6 +59,18 @@ class PkgHistoryProcessor:
 
     specfile_include_re = re.compile(rb"\n%include\s.*")
 
+    # These are used to find out which macros parsing a spec file defines, so they can be undefined
+    # afterwards. Macros defined in preamble tags are named after them, e.g. `Name` -> `%name` and
+    # `%NAME`, `Source1` -> `%SOURCE1` and `%SOURCEURL1`.
+    specfile_macro_definition_re = re.compile(rb"%(?:define|global)\s+(?P<name>\w+)")
+    specfile_tag_re = re.compile(
+        rb"^(?P<tag>[A-Za-z]+)(?P<number>\d*)\s*(?:\([^)]*\))?\s*:", flags=re.MULTILINE
+    )
+    specfile_implicit_macros = ("buildroot", "sources", "patches")
+
+    # Bump this if the format of cached spec file epoch-versions and flags changes.
+    rpmverflags_cache_version = 1
+
     def __init__(self, spec_or_path: Union[str, Path]):
         if isinstance(spec_or_path, str):
             spec_or_path = Path(spec_or_path)
@@ -63,7 +107,22 @@ class PkgHistoryProcessor:
         except pygit2.GitError:
             self.repo = None
 
-        self._rpmverflags_for_commits = {}
+        self._specfile_blob_ids: dict[pygit2.Oid, Optional[pygit2.Oid]] = {}
+        self._rpmverflags_for_blobs: dict[pygit2.Oid, Optional[dict[str, Any]]] = {}
+        self._rpmverflags_cache = None
+        self._rpm_session_stack = None
+        self._rpmlog = None
+
+    @cached_property
+    def _workdir(self) -> Path:
+        """Work directory for spec files to be parsed, created on first use.
+
+        Historical and abridged spec files get written here, one at a time.
+        It is cleaned up when the processor goes away.
+        """
+        workdir = Path(mkdtemp(prefix="rpmautospec-"))
+        weakref.finalize(self, rmtree, workdir, ignore_errors=True)
+        return workdir
 
     @staticmethod
     def _get_rpm_packager() -> str:
@@ -80,10 +139,162 @@ class PkgHistoryProcessor:
         except Exception:
             return fallback
 
+    @staticmethod
+    def _get_rpm_macros(path: Path) -> tuple[tuple[str, str], ...]:
+        """Get the macros to define when parsing spec files in `path`."""
+        python_version = str(sys.version_info[0]) + "." + str(sys.version_info[1])
+
+        return (
+            ("_invalid_encoding_terminates_build", "0"),
+            (AUTORELEASE_MACRO, "E%{?-e*}_S%{?-s*}_P%{?-p:1}%{!?-p:0}_B%{?-b*}"),
+            ("autochangelog", "%nil"),
+            ("__python", f"/usr/bin/python{python_version}"),
+            ("python_sitelib", f"/usr/lib/python{python_version}/site-packages"),
+            ("_sourcedir", str(path)),
+            ("_builddir", str(path)),
+        )
+
+    @contextmanager
+    def _rpm_session(self):
+        """Allow parsing historical spec files in process during a run.
+
+        The actual setup is deferred until a spec file has to be parsed, see
+        _prepare_rpm_in_process(), and is undone when leaving the context.
+        """
+        with ExitStack() as stack:
+            self._rpm_session_stack = stack
+            try:
+                yield
+            finally:
+                self._rpm_session_stack = None
+
+    def _prepare_rpm_in_process(self) -> Optional[IO[str]]:
+        """Set up parsing historical spec files in process, once per run.
+
+        This redirects messages logged by RPM into a temporary file and
+        defines the macros needed to parse spec files in the work directory.
+        When the run ends, these macros are undefined again, restoring any
+        previous definitions, and RPM logs to its default destinations
+        again: the RPM Python bindings have no way to query a previously set
+        log file.
+
+        Returns the file with messages logged by RPM, or None if spec files
+        can't be parsed in process, e.g. because the bindings aren't
+        available.
+        """
+        if rpm is None or self._rpm_session_stack is None:
+            return None
+
+        if self._rpmlog is None:
+            stack = self._rpm_session_stack
+
+            rpmlog = stack.enter_context(
+                TemporaryFile(mode="w+", encoding="utf-8", errors="replace")
+            )
+            rpm.setLogFile(rpmlog)
+            stack.callback(rpm.setLogFile, None)
+
+            for name, body in self._get_rpm_macros(self._workdir):
+                # rpm.addMacro() can't define parametric macros, so use %define instead.
+                rpm.expandMacro(f"%define {name} {body}")
+                stack.callback(rpm.delMacro, name.partition("(")[0])
+
+            self._rpmlog = rpmlog
+            stack.callback(setattr, self, "_rpmlog", None)
+
+        return self._rpmlog
+
+    @classmethod
+    def _get_specfile_macro_names(cls, specdata: bytes) -> dict[str, int]:
+        """Find which macros a spec file (possibly) defines.
+
+        Returns a dictionary mapping macro names to how often they're
+        defined in the spec file at most.
+        """
+        names = defaultdict(int)
+
+        for match in cls.specfile_macro_definition_re.finditer(specdata):
+            names[match.group("name").decode("utf-8", errors="replace")] += 1
+
+        for match in cls.specfile_tag_re.finditer(specdata):
+            tag = match.group("tag").decode("utf-8", errors="replace").lower()
+            number = match.group("number").decode("utf-8", errors="replace")
+            if tag in ("source", "patch"):
+                tag_macros = (f"{tag.upper()}{number}", f"{tag.upper()}URL{number}")
+            else:
+                tag_macros = (tag, tag.upper())
+            for tag_macro in tag_macros:
+                names[tag_macro] += 1
+
+        # Macros RPM defines itself when parsing a spec file.
+        for name in cls.specfile_implicit_macros:
+            names[name] += 1
+
+        return names
+
+    @staticmethod
+    def _get_macro_state(name: str, expand: bool = True) -> Optional[str]:
+        """Get the expanded value of a macro, or None if it's undefined."""
+        if rpm.expandMacro(f"%{{?{name}:1}}") != "1":
+            return None
+        if not expand:
+            return ""
+        return rpm.expandMacro(f"%{{{name}}}")
+
+    @classmethod
+    def _query_specfile_in_process(
+        cls, specpath: Path, query: str, rpmlog: IO[str]
+    ) -> Optional[str]:
+        """Query a spec file using the RPM Python bindings.
+
+        This expects that parsing in process is set up, see
+        _prepare_rpm_in_process(). Macros defined by the spec file are
+        undefined after parsing it, so they don't leak into parsing the next
+        one.
+
+        Returns None if parsing fails.
+        """
+        specfile_macros = cls._get_specfile_macro_names(specpath.read_bytes())
+        # Only look at the values of macros which were defined before, expanding those defined in
+        # the spec file could e.g. run shell commands.
+        macros_before = {name: cls._get_macro_state(name) for name in specfile_macros}
+
+        rpmlog.seek(0, io.SEEK_END)
+        rpmlog_pos = rpmlog.tell()
+
+        try:
+            spec = rpm.spec(str(specpath))
+            return spec.packages[0].header.format(query)
+        except Exception as exc:
+            rpmlog.seek(rpmlog_pos)
+            log.debug(
+                "parsing spec file %s in process failed: %s\n%s", specpath, exc, rpmlog.read()
+            )
+            return None
+        finally:
+            for name, max_definitions in specfile_macros.items():
+                before = macros_before[name]
+                for _ in range(max_definitions):
+                    state = cls._get_macro_state(name, expand=before is not None)
+                    if state is None or state == before:
+                        break
+                    rpm.delMacro(name)
+
     @classmethod
-    def _get_rpmverflags(cls, path: str, name: Optional[str] = None) -> Optional[str]:
+    def _get_rpmverflags(
+        cls,
+        path: str,
+        name: Optional[str] = None,
+        workdir: Optional[Path] = None,
+        rpmlog: Optional[IO[str]] = None,
+    ) -> Optional[dict[str, Any]]:
         """Retrieve the epoch/version and %autorelease flags set in spec file.
 
+        The abridged copy of the spec file is written into `workdir`, which
+        defaults to `path`. If `rpmlog` is set, the spec file is
+        parsed in process with the RPM Python bindings, otherwise with the
+        `rpm` command line tool.
+
         Returns None if an error is encountered.
         """
         path = Path(path)
@@ -98,36 +309,12 @@ class PkgHistoryProcessor:
 
         query = "%|epoch?{%{epoch}:}:{}|%{version}\n%{release}\n"
 
-        autorelease_definition = (
-            AUTORELEASE_MACRO + " E%{?-e*}_S%{?-s*}_P%{?-p:1}%{!?-p:0}_B%{?-b*}"
-        )
+        if not workdir:
+            workdir = path
 
-        python_version = str(sys.version_info[0]) + "." + str(sys.version_info[1])
+        abridged_path = Path(workdir) / f"rpmautospec-abridged-{name}.spec"
 
-        rpm_cmd_base = (
-            "rpm",
-            "--define",
-            "_invalid_encoding_terminates_build 0",
-            "--define",
-            autorelease_definition,
-            "--define",
-            "autochangelog %nil",
-            "--define",
-            f"__python /usr/bin/python{python_version}",
-            "--define",
-            f"python_sitelib /usr/lib/python{python_version}/site-packages",
-            "--define",
-            f"_sourcedir {path}",
-            "--define",
-            f"_builddir {path}",
-            "--qf",
-            query,
-            "--specfile",
-        )
-
-        with specfile.open(mode="rb") as unabridged, NamedTemporaryFile(
-            mode="wb", prefix=f"rpmautospec-abridged-{name}-", suffix=".spec"
-        ) as abridged:
+        with specfile.open(mode="rb") as unabridged, abridged_path.open(mode="wb") as abridged:
             # Attempt to parse a shortened version of the spec file first, to speed up processing in
             # certain cases. This includes all lines before `%prep`, i.e. in most cases everything
             # which is needed to make RPM parsing succeed and contain the info we want to extract.
@@ -137,35 +324,53 @@ class PkgHistoryProcessor:
                 abridged.write(line)
             abridged.flush()
 
-            for spec_candidate in (abridged.name, f"{name}.spec"):
-                call = subprocess.run(
-                    rpm_cmd_base + (spec_candidate,),
-                    cwd=path,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                )
-                if not call.returncode:
-                    # Parsing this candidate spec file succeeded. In the case of the abridged spec
-                    # file, we don’t need to parse the full spec file. In the case of the latter,
-                    # breaking out explicity doesn’t make a difference.
-                    break
+            spec_candidates = (abridged_path, specfile)
 
-        if call.returncode != 0:
-            log.debug("rpm query for %r failed: %s", query, call.stderr.decode("utf-8", "replace"))
-            return None
+            if rpmlog:
+                # Parsing in process is a lot cheaper than spawning `rpm` for every spec file.
+                for spec_candidate in spec_candidates:
+                    output = cls._query_specfile_in_process(spec_candidate, query, rpmlog)
+                    if output is not None:
+                        break
+                else:
+                    return None
+            else:
+                rpm_cmd_base = ("rpm",)
+                for macro_name, macro_body in cls._get_rpm_macros(path):
+                    rpm_cmd_base += ("--define", f"{macro_name} {macro_body}")
+                rpm_cmd_base += ("--qf", query, "--specfile")
+
+                for spec_candidate in spec_candidates:
+                    call = subprocess.run(
+                        rpm_cmd_base + (str(spec_candidate),),
+                        cwd=path,
+                        stdout=subprocess.PIPE,
+                        stderr=subprocess.PIPE,
+                    )
+                    if not call.returncode:
+                        # Parsing this candidate spec file succeeded. In the case of the abridged
+                        # spec file, we don’t need to parse the full spec file. In the case of the
+                        # latter, breaking out explicity doesn’t make a difference.
+                        break
 
-        output = call.stdout.decode("utf-8").strip()
+                if call.returncode != 0:
+                    log.debug(
+                        "rpm query for %r failed: %s", query, call.stderr.decode("utf-8", "replace")
+                    )
+                    return None
 
-        split_output = output.split("\n")
+                output = call.stdout.decode("utf-8")
+
+        split_output = output.strip().split("\n")
         epoch_version = split_output[0]
         info = split_output[1]
 
         match = cls.autorelease_flags_re.match(info)
         if match:
-            extraver = match.group("extraver") or None
-            snapinfo = match.group("snapinfo") or None
-            prerelease = match.group("prerelease") == "1"
-            base = match.group("base")
+            extraver, snapinfo, prerelease, base = match.groups()
+            extraver = extraver or None
+            snapinfo = snapinfo or None
+            prerelease = prerelease == "1"
             if base:
                 base = int(base)
             else:
@@ -183,40 +388,180 @@ class PkgHistoryProcessor:
 
         return result
 
+    @staticmethod
+    def _get_rpm_version() -> Optional[str]:
+        if rpm is not None:
+            return rpm.__version__
+
+        try:
+            # E.g. "RPM version 4.18.0"
+            return (
+                subprocess.check_output(("rpm", "--version"), stderr=subprocess.DEVNULL)
+                .decode("UTF-8")
+                .split()[-1]
+            )
+        except Exception:
+            return None
+
+    @staticmethod
+    def _get_rpm_macros_fingerprint() -> Optional[str]:
+        """Fingerprint the macro environment of RPM.
+
+        This hashes what `rpm --showrc` prints, i.e. among other things
+        the macro path and all macros defined after reading the files in
+        it, so changing, adding or removing macro files changes the
+        fingerprint.
+        """
+        try:
+            showrc = subprocess.check_output(("rpm", "--showrc"), stderr=subprocess.DEVNULL)
+        except Exception:
+            return None
+
+        return hashlib.sha256(showrc).hexdigest()[:16]
+
+    @contextmanager
+    def _persistent_rpmverflags_cache(self):
+        """Keep the on-disk cache for spec file epoch-versions and flags open.
+
+        The cache is opt-in: set $RPMAUTOSPEC_VERFLAGS_CACHE to "1" to
+        enable it. It lives in the git directory of the repository. Results
+        depend on the versions of RPM and Python, the macro environment and
+        the format of cached entries, so these are part of its file name,
+        and caches which don't match are removed. If any of these can't be
+        determined or the cache can't be opened, e.g. because the
+        repository is read-only, results are only cached in memory.
+        """
+        if (
+            os.getenv("RPMAUTOSPEC_VERFLAGS_CACHE", "").lower() not in ("1", "yes", "true", "on")
+            or not self.repo
+        ):
+            yield
+            return
+
+        rpm_version = self._get_rpm_version()
+        macros_fingerprint = self._get_rpm_macros_fingerprint()
+        if not rpm_version or not macros_fingerprint:
+            yield
+            return
+
+        python_version = f"{sys.version_info[0]}.{sys.version_info[1]}"
+        cache_dir = Path(self.repo.path)
+        cache_name = (
+            f"rpmautospec-verflags-v{self.rpmverflags_cache_version}"
+            + f"-rpm{rpm_version}-python{python_version}-{macros_fingerprint}.db"
+        )
+
+        # Depending on the dbm implementation, a cache consists of one or several files, all of
+        # which start with the name passed to shelve.open().
+        for stale_path in cache_dir.glob("rpmautospec-verflags-*"):
+            if not stale_path.name.startswith(cache_name):
+                try:
+                    stale_path.unlink()
+                except OSError as exc:
+                    log.debug("Can't remove stale cache %s: %s", stale_path, exc)
+
+        cache_path = cache_dir / cache_name
+        try:
+            cache = shelve.open(str(cache_path))
+        except Exception as exc:
+            log.debug("Can't open cache %s: %s", cache_path, exc)
+            yield
+            return
+
+        self._rpmverflags_cache = cache
+        try:
+            yield
+        finally:
+            self._rpmverflags_cache = None
+            cache.close()
+
+    def _get_specfile_blob_id(self, commit: pygit2.Commit) -> Optional[pygit2.Oid]:
+        """Look up the id of the spec file blob in a commit.
+
+        Returns None if the commit doesn't contain the spec file. Results are
+        cached because most commits are looked at repeatedly, in their own
+        right as well as parents of other commits.
+        """
+        try:
+            return self._specfile_blob_ids[commit.id]
+        except KeyError:
+            pass
+
+        try:
+            blob_id = commit.tree[self.specfile.name].id
+        except KeyError:
+            blob_id = None
+
+        self._specfile_blob_ids[commit.id] = blob_id
+
+        return blob_id
+
     def _get_rpmverflags_for_commit(self, commit):
-        if commit in self._rpmverflags_for_commits:
-            return self._rpmverflags_for_commits[commit]
+        blob_id = self._get_specfile_blob_id(commit)
+        if blob_id is None:
+            # no spec file
+            return None
 
-        with TemporaryDirectory(prefix="rpmautospec-") as workdir:
+        # The results only depend on the contents of the spec file, i.e. the blob, and many commits
+        # share the same spec file blob. Cache them by the blob id, in memory and across runs.
+        if blob_id in self._rpmverflags_for_blobs:
+            return self._rpmverflags_for_blobs[blob_id]
+
+        persistent_cache = self._rpmverflags_cache
+        verflags = None
+        if persistent_cache is not None:
             try:
-                specblob = commit.tree[self.specfile.name]
-            except KeyError:
-                # no spec file
-                return None
+                verflags = persistent_cache.get(str(blob_id))
+            except Exception as exc:
+                # Treat broken entries as missing, they'll be overwritten.
+                log.debug("Can't read cached verflags for blob %s: %s", blob_id, exc)
 
-            specpath = Path(workdir) / self.specfile.name
+        if verflags is None:
+            specpath = self._workdir / self.specfile.name
+
+            # Read the blob contents directly from the object database, no need to wrap it in a
+            # pygit2.Blob object first.
+            specdata = self.repo.odb.read(blob_id)[1]
 
             # Filter out any %include directives. They would cause
             # spec file evaluation to fail.
-            specdata = self.specfile_include_re.sub(b"", specblob.data)
+            specdata = self.specfile_include_re.sub(b"", specdata)
 
             specpath.write_bytes(specdata)
 
-            self._rpmverflags_for_commits[commit] = self._get_rpmverflags(workdir, self.name)
+            verflags = self._get_rpmverflags(
+                self._workdir,
+                self.name,
+                rpmlog=self._prepare_rpm_in_process(),
+            )
+
+            # Don't persist failures, they could be caused by the environment (e.g. missing macro
+            # files) rather than the spec file.
+            if verflags and persistent_cache is not None:
+                try:
+                    persistent_cache[str(blob_id)] = verflags
+                except Exception as exc:
+                    log.debug("Can't cache verflags for blob %s: %s", blob_id, exc)
+
+        self._rpmverflags_for_blobs[blob_id] = verflags
 
-        return self._rpmverflags_for_commits[commit]
+        return verflags
 
-    def release_number_visitor(self, commit: pygit2.Commit, child_info: dict[str, Any]):
-        """Visit a commit to determine its release number.
+    @property
+    def release_number_visitor(self) -> Visitor:
+        """Visitor determining the release number of commits.
 
-        The coroutine returned first determines if the parent chain(s) must be
-        followed, i.e. if one parent has the same package epoch-version,
-        suspends execution and yields that to the caller (usually the walk()
-        method), who later sends the partial results for this commit (to be
-        modified) and full results of parents back (as dictionaries), resuming
-        execution to process these and finally yield back the results for this
-        commit.
+        Its top half determines if the parent chain(s) must be followed,
+        i.e. if one parent has the same package epoch-version. Its bottom
+        half gets the partial results for the commit (to be modified) and
+        the full results of its parents and computes the release number.
         """
+        return Visitor(self._release_number_visitor_pre, self._release_number_visitor_post)
+
+    def _release_number_visitor_pre(
+        self, commit: pygit2.Commit, child_info: dict[str, Any]
+    ) -> tuple[dict[str, Any], Any]:
+        blob_id = self._get_specfile_blob_id(commit)
         verflags = self._get_rpmverflags_for_commit(commit)
 
         if verflags:
@@ -233,6 +578,10 @@ class PkgHistoryProcessor:
 
         if not epoch_version:
             child_must_continue = True
+        elif any(self._get_specfile_blob_id(p) == blob_id for p in commit.parents):
+            # A parent with an unchanged spec file has the same epoch-version, no need to evaluate
+            # it or any other parent.
+            child_must_continue = True
         else:
             epoch_versions_to_check = []
             for p in commit.parents:
@@ -249,9 +598,22 @@ class PkgHistoryProcessor:
         log.debug("\tepoch_version: %s", epoch_version)
         log.debug("\tchild must continue: %s", child_must_continue)
 
-        # Suspend execution, yield whether caller should continue, and get back the (partial) result
-        # for this commit and parent results as dictionaries on resume.
-        commit_result, parent_results = yield {"child_must_continue": child_must_continue}
+        # Return whether the caller should continue, and what the bottom half needs to know.
+        return {"child_must_continue": child_must_continue}, (
+            epoch_version,
+            prerelease,
+            base,
+            tag_string,
+        )
+
+    def _release_number_visitor_post(
+        self,
+        commit: pygit2.Commit,
+        state: Any,
+        commit_result: dict[str, Any],
+        parent_results: list[dict[str, Any]],
+    ) -> dict[str, Any]:
+        epoch_version, prerelease, base, tag_string = state
 
         commit_result["epoch-version"] = epoch_version
 
@@ -280,7 +642,7 @@ class PkgHistoryProcessor:
             default=0,
         )
 
-        if self.specfile.name in commit.tree:
+        if self._get_specfile_blob_id(commit) is not None:
             release_number += 1
 
         commit_result["release-number"] = release_number
@@ -291,7 +653,7 @@ class PkgHistoryProcessor:
         release_number_with_base = release_number + base - 1
         commit_result["release-complete"] = f"{prerel_str}{release_number_with_base}{tag_string}"
 
-        yield commit_result
+        return commit_result
 
     @staticmethod
     def _files_changed_in_diff(diff: pygit2.Diff):
@@ -303,18 +665,23 @@ class PkgHistoryProcessor:
                 files.add(delta.new_file.path)
         return files
 
-    def changelog_visitor(self, commit: pygit2.Commit, child_info: dict[str, Any]):
-        """Visit a commit to generate changelog entries for it and its parents.
+    @property
+    def changelog_visitor(self) -> Visitor:
+        """Visitor generating changelog entries for commits and their parents.
 
-        It first determines if parent chain(s) must be followed, i.e. if the
-        changelog file was modified in this commit and yields that to the
-        caller, who later sends the partial results for this commit (to be
-        modified) and full results of parents back (as dictionaries), which
-        get processed and the results for this commit yielded again.
+        Its top half determines if parent chain(s) must be followed, i.e. if
+        the changelog file was modified in this commit. Its bottom half gets
+        the partial results for the commit (to be modified) and the full
+        results of its parents and generates the changelog.
         """
+        return Visitor(self._changelog_visitor_pre, self._changelog_visitor_post)
+
+    def _changelog_visitor_pre(
+        self, commit: pygit2.Commit, child_info: dict[str, Any]
+    ) -> tuple[dict[str, Any], Any]:
         child_must_continue = child_info["child_must_continue"]
         # Check if the spec file exists, if not, there will be no changelog.
-        specfile_present = f"{self.name}.spec" in commit.tree
+        specfile_present = self._get_specfile_blob_id(commit) is not None
 
         # Find out if the changelog is different from every parent (or present, in the case of the
         # root commit).
@@ -371,11 +738,35 @@ class PkgHistoryProcessor:
         log.debug("\tchild must continue (incoming): %s", child_must_continue)
         log.debug("\tchild must continue (outgoing): %s", our_child_must_continue)
 
-        commit_result, parent_results = yield {
+        # Return whether the caller should continue, and what the bottom half needs to know.
+        return {
             "child_must_continue": our_child_must_continue,
             "changelog_removed": not (changelog_blob and changelog_changed)
             and (child_changelog_removed or our_changelog_removed),
-        }
+        }, (
+            specfile_present,
+            changelog_blob,
+            changelog_changed,
+            child_changelog_removed,
+            parent_to_follow,
+            merge_unresolvable,
+        )
+
+    def _changelog_visitor_post(
+        self,
+        commit: pygit2.Commit,
+        state: Any,
+        commit_result: dict[str, Any],
+        parent_results: list[dict[str, Any]],
+    ) -> dict[str, Any]:
+        (
+            specfile_present,
+            changelog_blob,
+            changelog_changed,
+            child_changelog_removed,
+            parent_to_follow,
+            merge_unresolvable,
+        ) = state
 
         changelog_entry = ChangelogEntry(
             {
@@ -430,7 +821,7 @@ class PkgHistoryProcessor:
             else:
                 commit_result["changelog"] = previous_changelog
 
-        yield commit_result
+        return commit_result
 
     @staticmethod
     def _merge_info(f1: dict[str, Any], f2: dict[str, Any]) -> dict[str, Any]:
@@ -461,28 +852,25 @@ class PkgHistoryProcessor:
         # child commit which doesn’t exist.
         seed_info = {"child_must_continue": True} | (seed_info or {})
 
-        # These map visited commits to their (in-flight) visitor coroutines and tracks if they must
-        # continue and other auxiliary information.
-        commit_coroutines = {}
-        commit_coroutines_info = {}
-
-        # This keeps track of the heads of branches that need to be processed.
-        branch_heads = [head]
-        # This stores the discovered snippets, i.e. linear chains of commits.
-        snippets = []
+        # These map visited commits to the state their visitors' top halves pass on to the bottom
+        # halves, and track if they must continue and other auxiliary information.
+        commit_visitors_state = {}
+        commit_visitors_info = {}
 
         # Unfortunately, pygit2 only tells us what the parents of a commit are, not what other
-        # commits a commit is parent to (its children). Fortunately, Repository.walk() is quick.
-        # This maps parent commits to their children.
+        # commits a commit is parent to (its children). This maps parent commits to their children
+        # and is filled while walking the history.
         commit_children = defaultdict(list)
-        for commit in self.repo.walk(head.id):
-            for parent in commit.parents:
-                commit_children[parent].append(commit)
+
+        # This stores the visited commits in topological order, i.e. every commit is preceded by all
+        # of its children.
+        topo_order = []
 
         ##########################################################################################
-        # To process, first walk the tree from the head commit downward, following all branches.
-        # Check visitors whether they need parent results to do their work, i.e. the history needs
-        # to be processed further, or just traversed.
+        # To process, first walk the history from the head commit downward in topological order,
+        # i.e. a commit is only encountered after all of its children, which means their
+        # information is complete at this point. Check visitors whether they need parent results
+        # to do their work, i.e. the history needs to be processed further, or just traversed.
         #
         # Here, the “top halves” of visitors get merged information from their child commit(s) as
         # well as from visitors that ran prior on the same commit. In practice: during runtime,
@@ -490,176 +878,93 @@ class PkgHistoryProcessor:
         # commit.
         ##########################################################################################
 
-        log.debug("===========================================================")
-        log.debug("Extracting linear history snippets from branched history...")
-        log.debug("===========================================================")
-
-        # While new branch heads are encountered...
-        while branch_heads:
-            commit = branch_heads.pop(0)
-            snippet = []
-            snippets.append(snippet)
-
-            keep_processing = True
-
-            while True:
-                if commit in commit_coroutines:
-                    # This commit was processed already, so `snippet` can be cut off before it.
-                    log.debug("%s: coroutines exist, skipping", commit.short_id)
-                    break
-
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("commit %s: %s", commit.short_id, commit.message.split("\n", 1)[0])
+        log.debug("=====================================")
+        log.debug("Walking history in topological order...")
+        log.debug("=====================================")
 
-                if commit == head:
-                    # Set the stage for the first commit: Visitors expect to get some information
-                    # from their child commit(s), as there aren’t any yet, fake it.
-                    children_visitors_info = [seed_info for v in visitors]
-                else:
-                    this_children = commit_children[commit]
-                    if not all(child in commit_coroutines for child in this_children):
-                        # There's another branch that leads to this parent, put the remainder on the
-                        # stack.
-                        branch_heads.append(commit)
-
-                        if not snippet:
-                            # Don't keep empty snippets on the stack.
-                            snippets.pop()
-
-                        if log.isEnabledFor(logging.DEBUG):
-                            log.debug(
-                                "\tunencountered children, putting remainder of snippet aside"
-                            )
-                            log.debug(
-                                "\tmissing children: %s",
-                                [
-                                    child.short_id
-                                    for child in this_children
-                                    if child not in commit_coroutines
-                                ],
-                            )
+        for commit in self.repo.walk(head.id, pygit2.GIT_SORT_TOPOLOGICAL):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("commit %s: %s", commit.short_id, commit.message.partition("\n")[0])
 
-                        break
+            topo_order.append(commit)
 
-                    # For all visitor coroutines, merge their produced info, e.g. to determine if
-                    # any of the children must continue.
-                    children_visitors_info = [
-                        reduce(
-                            lambda info, child: self._merge_info(
-                                info, commit_coroutines_info[child][vindex]
-                            ),
-                            this_children,
-                            {},
-                        )
-                        for vindex, v in enumerate(visitors)
-                    ]
-
-                    keep_processing = keep_processing and any(
-                        info["child_must_continue"] for info in children_visitors_info
+            if commit == head:
+                # Set the stage for the first commit: Visitors expect to get some information
+                # from their child commit(s), as there aren’t any yet, fake it.
+                children_visitors_info = [seed_info for v in visitors]
+                keep_processing = True
+            else:
+                this_children = commit_children[commit]
+
+                # For all visitors, merge their produced info, e.g. to determine if any of the
+                # children must continue.
+                children_visitors_info = [
+                    reduce(self._merge_info, children_infos, {})
+                    for children_infos in zip(
+                        *(commit_visitors_info[child] for child in this_children)
                     )
+                ]
 
-                snippet.append(commit)
-
-                if keep_processing:
-                    # Create visitor coroutines for the commit from the functions passed into this
-                    # method. Pass the ordered list of "is there a child whose coroutine of the same
-                    # visitor wants to continue" into it.
-                    commit_coroutines[commit] = coroutines = [
-                        v(commit, children_visitors_info[vi]) for vi, v in enumerate(visitors)
-                    ]
-
-                    # Consult all visitors for the commit on whether we should continue and store
-                    # the results.
-                    commit_coroutines_info[commit] = [next(c) for c in coroutines]
-                else:
-                    # Only traverse this commit. Traversal is important if parent commits are the
-                    # root of branches that affect the results (computed release number and
-                    # generated changelog).
-                    commit_coroutines[commit] = coroutines = None
-                    commit_coroutines_info[commit] = [
-                        {"child_must_continue": False} for v in visitors
-                    ]
-
-                if not commit.parents:
-                    log.debug("\tno parents, bailing out")
-                    break
+                keep_processing = any(
+                    info["child_must_continue"] for info in children_visitors_info
+                )
 
-                if len(commit.parents) > 1:
-                    # merge commit, store new branch head(s) to follow later
-                    branch_parents = commit.parents[1:]
-                    new_branches = [p for p in branch_parents if p not in commit_coroutines]
-                    branch_heads.extend(new_branches)
-                    if log.isEnabledFor(logging.DEBUG):
-                        log.debug("\tnew branch heads %s", [x.short_id for x in new_branches])
-                        log.debug("\tbranch heads: %s", [x.short_id for x in branch_heads])
+            if keep_processing:
+                # Run the top halves of the visitors passed into this method for the commit. Pass
+                # in the merged info ("is there a child for which the same visitor wants to
+                # continue" etc.) and store whether we should continue as well as the state for the
+                # bottom halves.
+                commit_visitors_info[commit] = visitors_info = []
+                commit_visitors_state[commit] = visitors_state = []
+                for visitor, child_info in zip(visitors, children_visitors_info):
+                    info, state = visitor.pre(commit, child_info)
+                    visitors_info.append(info)
+                    visitors_state.append(state)
+            else:
+                # Only traverse this commit. Traversal is important if parent commits are the
+                # root of branches that affect the results (computed release number and
+                # generated changelog).
+                log.debug("\tonly traverse")
+                commit_visitors_state[commit] = None
+                commit_visitors_info[commit] = [{"child_must_continue": False} for v in visitors]
 
-                # follow (first) parent
-                commit = commit.parents[0]
-                log.debug("\tparent to follow: %s", commit.short_id)
+            for parent in commit.parents:
+                commit_children[parent].append(commit)
 
         ###########################################################################################
-        # Now, `snippets` contains disjunct lists of commits in new -> old order. Process these in
-        # reverse, one at a time until encountering a commit where we don't know the results of all
-        # parents. Then put the remainder back on the stack to be further processed later until we
-        # run out of snippets with commits.
+        # Now, process the commits in reverse topological order, i.e. the results of all parents of
+        # a commit are known when it is encountered.
         #
         # Here, the “bottom halves” of visitors get results from their parent commit(s) as well as
         # visitors run prior on the same commit, i.e. `release_number_visitor()` ->
         # `changelog_visitor()`.
         ###########################################################################################
 
-        log.debug("=====================================")
-        log.debug("Processing linear history snippets...")
-        log.debug("=====================================")
+        log.debug("===================================================")
+        log.debug("Processing history in reverse topological order...")
+        log.debug("===================================================")
 
         # This maps commits to their results.
         visited_results = {}
 
-        while snippets:
-            snippet = snippets.pop(0)
-            if snippet:
-                log.debug("Processing snippet %s", snippet[0].short_id)
-            while snippet:
-                # Take one commit from the tail end of the snippet and process.
-                commit = snippet.pop()
-
-                if log.isEnabledFor(logging.DEBUG):
-                    log.debug("commit %s: %s", commit.short_id, commit.message.split("\n", 1)[0])
-
-                if commit_coroutines[commit] is None:
-                    # Only traverse, but don't process this commit. Ancestral commits might have to
-                    # be taken into account again, so we can’t simply stop here.
-                    log.debug("\tonly traverse")
-                    continue
-
-                for p in commit.parents:
-                    if log.isEnabledFor(logging.DEBUG):
-                        log.debug(
-                            "\t%s: p in visited results: %s", p.short_id, p in visited_results
-                        )
-                        log.debug(
-                            "\tcommit_coroutines[p] is None: %s", commit_coroutines[p] is None
-                        )
-
-                if not all(
-                    p in visited_results or commit_coroutines[p] is None for p in commit.parents
-                ):
-                    # This commit doesn’t have all information it needs to be processed. Put it and
-                    # the remainder of the snippet back to be processed later.
-                    log.debug("\tputting back")
-                    snippet.append(commit)
-                    snippets.append(snippet)
-                    break
+        for commit in reversed(topo_order):
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("commit %s: %s", commit.short_id, commit.message.partition("\n")[0])
 
-                parent_results = [visited_results.get(p, {}) for p in commit.parents]
+            if commit_visitors_state[commit] is None:
+                # Only traverse, but don't process this commit. Ancestral commits might have to
+                # be taken into account again, so we can’t simply stop here.
+                log.debug("\tonly traverse")
+                continue
 
-                # "Pipe" the (partial) result dictionaries through the second half of all visitors
-                # for the commit.
-                visited_results[commit] = reduce(
-                    lambda commit_result, visitor: visitor.send((commit_result, parent_results)),
-                    commit_coroutines[commit],
-                    {"commit-id": commit.id},
-                )
+            parent_results = [visited_results.get(p, {}) for p in commit.parents]
+
+            # "Pipe" the (partial) result dictionaries through the bottom halves of all visitors
+            # for the commit.
+            commit_result = {"commit-id": commit.id}
+            for visitor, state in zip(visitors, commit_visitors_state[commit]):
+                commit_result = visitor.post(commit, state, commit_result, parent_results)
+            visited_results[commit] = commit_result
 
         return visited_results
 
@@ -671,6 +976,16 @@ class PkgHistoryProcessor:
         all_results: bool = False,
     ) -> Union[dict[str, Any], dict[pygit2.Commit, dict[str, Any]]]:
         """Process a package repository including a changed worktree."""
+        with self._persistent_rpmverflags_cache(), self._rpm_session():
+            return self._run(head, visitors=visitors, all_results=all_results)
+
+    def _run(
+        self,
+        head: Optional[Union[str, pygit2.Commit]],
+        *,
+        visitors: Sequence,
+        all_results: bool,
+    ) -> Union[dict[str, Any], dict[pygit2.Commit, dict[str, Any]]]:
         # whether or not the worktree differs and this needs to be reflected in the result(s)
         reflect_worktree = False
 
@@ -678,8 +993,10 @@ class PkgHistoryProcessor:
             seed_info = None
             if not head:
                 head = self.repo[self.repo.head.target]
+                # Only the number of changed files matters here. Unlike `Diff.stats`, this doesn’t
+                # need to compute patches of their contents.
                 diff_to_head = self.repo.diff(head)
-                reflect_worktree = diff_to_head.stats.files_changed > 0
+                reflect_worktree = len(diff_to_head) > 0
                 if (
                     reflect_worktree
                     and not (self.specfile.parent / "changelog").exists()
@@ -700,7 +1017,7 @@ class PkgHistoryProcessor:
             # Not a git repository, or the git worktree isn't clean.
             worktree_result = {}
 
-            verflags = self._get_rpmverflags(self.path, name=self.name)
+            verflags = self._get_rpmverflags(self.path, name=self.name, workdir=self._workdir)
             if not verflags:
                 # assume same as head commit, not ideal but hey
                 verflags = self._get_rpmverflags_for_commit(self.repo[self.repo.head.target])
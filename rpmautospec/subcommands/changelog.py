@@ -38,11 +38,9 @@ def collate_changelog(
     processor_results: dict[str, Any], result_type: Optional[type] = str
 ) -> Union[str, bytes]:
     changelog = processor_results["changelog"]
-    if result_type == str:
-        entry_strings = (_coerce_to_str(entry.format()) for entry in changelog)
-    else:
-        entry_strings = (_coerce_to_bytes(entry.format()) for entry in changelog)
-    return "\n\n".join(entry_strings)
+    coerce = _coerce_to_str if result_type == str else _coerce_to_bytes
+    entry_strings = [coerce(entry.format()) for entry in changelog]
+    return coerce("\n\n").join(entry_strings)
 
 
 def produce_changelog(spec_or_repo):
@@ -0,0 +1,25 @@
+from unittest import mock
+
+import pytest
+
+from rpmautospec.subcommands import changelog
+
+
+class TestChangelog:
+    """Test the rpmautospec.subcommands.changelog module"""
+
+    @pytest.mark.parametrize("result_type", (str, bytes))
+    def test_collate_changelog(self, result_type):
+        entries = []
+        for formatted in ("* Entry 2\n- Did something", b"* Entry 1\n- Did something \xc3\xa9lse"):
+            entry = mock.Mock()
+            entry.format.return_value = formatted
+            entries.append(entry)
+
+        result = changelog.collate_changelog({"changelog": entries}, result_type=result_type)
+
+        expected = "* Entry 2\n- Did something\n\n* Entry 1\n- Did something élse"
+        if result_type == bytes:
+            expected = expected.encode("utf-8")
+
+        assert result == expected
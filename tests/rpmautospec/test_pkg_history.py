@@ -1,17 +1,77 @@
 import datetime as dt
 import locale
+import logging
 import os
 import re
 import stat
 from calendar import LocaleTextCalendar
-from shutil import rmtree, SpecialFileError
-from unittest.mock import patch
+from collections import defaultdict
+from pathlib import Path
+from shutil import copy2, rmtree, SpecialFileError, which
+from tempfile import TemporaryFile
+from unittest.mock import ANY, MagicMock, patch
 
 import pygit2
 import pytest
 
 from rpmautospec.pkg_history import PkgHistoryProcessor
 
+TEST_SPECFILES_DIR = Path(__file__).parent.parent / "test-data" / "test-specfiles"
+
+
+class FakeRPM:
+    """Mimic the parts of the RPM Python bindings used to parse spec files."""
+
+    macro_definition_re = re.compile(r"^%define (?P<name>\w+)(?:\([^)]*\))? (?P<body>.*)$")
+    macro_defined_re = re.compile(r"^%\{\?(?P<name>\w+):1\}$")
+    macro_re = re.compile(r"^%\{(?P<name>\w+)\}$")
+    tag_re = re.compile(r"^(?P<tag>\w+):\s*(?P<value>.*)$")
+    global_re = re.compile(r"^%global (?P<name>\w+) (?P<body>.*)$")
+
+    def __init__(self, fail=False):
+        self.macros = defaultdict(list)
+        self.logfile = None
+        self.fail = fail
+        self.parsed = 0
+
+    def expandMacro(self, expr):
+        if match := self.macro_definition_re.match(expr):
+            self.macros[match.group("name")].append(match.group("body"))
+            return ""
+        if match := self.macro_defined_re.match(expr):
+            return "1" if self.macros[match.group("name")] else ""
+        if match := self.macro_re.match(expr):
+            return self.macros[match.group("name")][-1]
+        raise NotImplementedError(expr)
+
+    def delMacro(self, name):
+        if self.macros[name]:
+            self.macros[name].pop()
+
+    def setLogFile(self, logfile):
+        self.logfile = logfile
+
+    def spec(self, path):
+        self.parsed += 1
+
+        with open(path) as specfile:
+            for line in specfile:
+                if match := self.tag_re.match(line):
+                    tag = match.group("tag")
+                    self.macros[tag.lower()].append(match.group("value"))
+                    self.macros[tag.upper()].append(match.group("value"))
+                elif match := self.global_re.match(line):
+                    self.macros[match.group("name")].append(match.group("body"))
+        self.macros["buildroot"].append("/buildroot")
+
+        if self.fail:
+            self.logfile.write("error: line 1: Unknown tag: Boo!\n")
+            raise ValueError("can't parse specfile")
+
+        spec = MagicMock()
+        spec.packages[0].header.format.return_value = "1:1.0\nEfoo_S_P1_B\n"
+        return spec
+
 
 @pytest.fixture
 def processor(repo):
@@ -118,6 +178,21 @@ class TestPkgHistoryProcessor:
         else:
             assert processor.repo
 
+    def test__workdir(self, repo):
+        processor = PkgHistoryProcessor(repo.workdir)
+
+        # The work directory is only created when needed.
+        assert "_workdir" not in vars(processor)
+
+        workdir = processor._workdir
+
+        assert workdir.is_dir()
+        assert processor._workdir == workdir
+
+        del processor
+
+        assert not workdir.exists()
+
     @pytest.mark.parametrize("testcase", ("normal", "no spec file"))
     def test__get_rpmverflags_for_commit(self, testcase, specfile, repo, processor):
         head_commit = repo[repo.head.target]
@@ -161,6 +236,249 @@ class TestPkgHistoryProcessor:
 
             _get_rpmverflags.assert_not_called()
 
+            # The parent commit has the same spec file blob.
+            assert processor._get_rpmverflags_for_commit(head_commit.parents[0]) is sentinel
+
+            _get_rpmverflags.assert_not_called()
+
+    @pytest.mark.parametrize(
+        "testcase", ("cached", "disabled", "other rpm version", "other macros", "broken entry")
+    )
+    def test__get_rpmverflags_for_commit_persistent_cache(
+        self, testcase, specfile, repo, processor, monkeypatch
+    ):
+        if testcase != "disabled":
+            monkeypatch.setenv("RPMAUTOSPEC_VERFLAGS_CACHE", "1")
+
+        rpm_version = "4.18.0"
+        macros_fingerprint = "0123456789abcdef"
+
+        head_commit = repo[repo.head.target]
+        verflags = {
+            "epoch-version": "1.0",
+            "extraver": None,
+            "snapinfo": None,
+            "prerelease": False,
+            "base": 1,
+        }
+
+        def cache_files():
+            return sorted(Path(repo.path).glob("rpmautospec-verflags-*"))
+
+        with patch.object(
+            PkgHistoryProcessor, "_get_rpm_version", staticmethod(lambda: rpm_version)
+        ), patch.object(
+            PkgHistoryProcessor,
+            "_get_rpm_macros_fingerprint",
+            staticmethod(lambda: macros_fingerprint),
+        ):
+            with processor._persistent_rpmverflags_cache(), patch.object(
+                processor, "_get_rpmverflags", return_value=verflags
+            ) as _get_rpmverflags:
+                assert processor._get_rpmverflags_for_commit(head_commit) == verflags
+                _get_rpmverflags.assert_called_once()
+
+                if testcase == "broken entry":
+                    blob_key = str(head_commit.tree[specfile.name].id)
+                    processor._rpmverflags_cache.dict[blob_key.encode()] = b"Boo!"
+
+            if testcase == "disabled":
+                assert not cache_files()
+            else:
+                old_cache_files = cache_files()
+                assert old_cache_files
+
+            if testcase == "other rpm version":
+                rpm_version = "4.19.0"
+            elif testcase == "other macros":
+                macros_fingerprint = "fedcba9876543210"
+
+            # Both commits share the same spec file blob.
+            processor = PkgHistoryProcessor(repo.workdir)
+
+            with processor._persistent_rpmverflags_cache(), patch.object(
+                processor, "_get_rpmverflags", return_value=verflags
+            ) as _get_rpmverflags:
+                assert processor._get_rpmverflags_for_commit(head_commit.parents[0]) == verflags
+                if testcase == "cached":
+                    _get_rpmverflags.assert_not_called()
+                else:
+                    _get_rpmverflags.assert_called_once()
+
+        if testcase in ("other rpm version", "other macros"):
+            # Caches for other environments are removed.
+            assert not set(old_cache_files) & set(cache_files())
+            assert cache_files()
+
+    @pytest.mark.parametrize("testcase", ("bindings", "command line", "unavailable"))
+    @patch("rpmautospec.pkg_history.subprocess.check_output")
+    def test__get_rpm_version(self, check_output, testcase):
+        if testcase == "bindings":
+            rpm = MagicMock(__version__="4.18.0")
+        else:
+            rpm = None
+
+        if testcase == "unavailable":
+            check_output.side_effect = FileNotFoundError()
+        else:
+            check_output.return_value = b"RPM version 4.18.1\n"
+
+        with patch("rpmautospec.pkg_history.rpm", rpm):
+            rpm_version = PkgHistoryProcessor._get_rpm_version()
+
+        if testcase == "bindings":
+            assert rpm_version == "4.18.0"
+            check_output.assert_not_called()
+        elif testcase == "command line":
+            assert rpm_version == "4.18.1"
+        else:
+            assert rpm_version is None
+
+    @pytest.mark.parametrize("testcase", ("same", "changed", "unavailable"))
+    @patch("rpmautospec.pkg_history.subprocess.check_output")
+    def test__get_rpm_macros_fingerprint(self, check_output, testcase):
+        check_output.return_value = b"Macro path: /usr/lib/rpm/macros\n-14: foo\tbar\n"
+        fingerprint = PkgHistoryProcessor._get_rpm_macros_fingerprint()
+
+        assert fingerprint
+        check_output.assert_called_once_with(("rpm", "--showrc"), stderr=ANY)
+
+        if testcase == "same":
+            assert PkgHistoryProcessor._get_rpm_macros_fingerprint() == fingerprint
+        elif testcase == "changed":
+            check_output.return_value = b"Macro path: /usr/lib/rpm/macros\n-14: foo\tbaz\n"
+            assert PkgHistoryProcessor._get_rpm_macros_fingerprint() != fingerprint
+        else:
+            check_output.side_effect = FileNotFoundError()
+            assert PkgHistoryProcessor._get_rpm_macros_fingerprint() is None
+
+    def test__release_number_visitor_pre_unchanged_specfile(self, repo, processor):
+        head_commit = repo[repo.head.target]
+        verflags = {
+            "epoch-version": "1.0",
+            "extraver": None,
+            "snapinfo": None,
+            "prerelease": False,
+            "base": 1,
+        }
+
+        with patch.object(processor, "_get_rpmverflags", return_value=verflags), patch.object(
+            processor, "_get_rpmverflags_for_commit", wraps=processor._get_rpmverflags_for_commit
+        ) as _get_rpmverflags_for_commit:
+            info, _ = processor._release_number_visitor_pre(head_commit, {})
+
+        assert info["child_must_continue"]
+        # The parent commit has the same spec file blob, it doesn't need to be evaluated.
+        _get_rpmverflags_for_commit.assert_called_once_with(head_commit)
+
+    @pytest.mark.parametrize("testcase", ("in process", "in process, failing", "command line"))
+    @patch("rpmautospec.pkg_history.subprocess")
+    def test__get_rpmverflags(self, subprocess, testcase, specfile, caplog):
+        caplog.set_level(logging.DEBUG, logger="rpmautospec.pkg_history")
+        specfile.write_text(
+            specfile.read_text().replace(
+                "License: CC0", "License: CC0\nPackager: Boo <boo@example.com>\n%global foo bar"
+            )
+        )
+
+        rpm = FakeRPM(fail="failing" in testcase)
+        rpm.expandMacro("%define packager Jane Doe <jane.doe@example.com>")
+        macros_before = {name: list(stack) for name, stack in rpm.macros.items()}
+
+        with patch("rpmautospec.pkg_history.rpm", rpm), TemporaryFile(mode="w+") as rpmlog:
+            if "in process" in testcase:
+                rpm.setLogFile(rpmlog)
+                kwargs = {"rpmlog": rpmlog}
+            else:
+                kwargs = {}
+                subprocess.run.return_value.returncode = 0
+                subprocess.run.return_value.stdout = b"1:1.0\nEfoo_S_P1_B\n"
+
+            result = PkgHistoryProcessor._get_rpmverflags(specfile.parent, specfile.stem, **kwargs)
+
+        if "failing" in testcase:
+            assert result is None
+            assert "error: line 1: Unknown tag: Boo!" in caplog.text
+        else:
+            assert result == {
+                "epoch-version": "1:1.0",
+                "extraver": "foo",
+                "snapinfo": None,
+                "prerelease": True,
+                "base": 1,
+            }
+
+        # Macros defined in the spec file don't linger, previous definitions are restored.
+        assert {name: stack for name, stack in rpm.macros.items() if stack} == macros_before
+
+        if "in process" in testcase:
+            assert rpm.parsed == 2 if "failing" in testcase else 1
+            subprocess.run.assert_not_called()
+        else:
+            assert not rpm.parsed
+            subprocess.run.assert_called_once()
+            args = subprocess.run.call_args[0][0]
+            assert args[:3] == ("rpm", "--define", "_invalid_encoding_terminates_build 0")
+            assert subprocess.run.call_args[1]["cwd"] == specfile.parent
+
+    def test__prepare_rpm_in_process(self, processor):
+        rpm = FakeRPM()
+        rpm.expandMacro("%define _sourcedir /somewhere")
+        macros_before = {name: list(stack) for name, stack in rpm.macros.items()}
+
+        with patch("rpmautospec.pkg_history.rpm", rpm):
+            # Parsing in process is only possible during a run.
+            assert processor._prepare_rpm_in_process() is None
+
+            with processor._rpm_session():
+                rpmlog = processor._prepare_rpm_in_process()
+
+                assert rpmlog
+                assert rpm.logfile is rpmlog
+                assert rpm.macros["autochangelog"] == ["%nil"]
+                assert rpm.macros["_sourcedir"] == ["/somewhere", str(processor._workdir)]
+
+                # This is only set up once.
+                assert processor._prepare_rpm_in_process() is rpmlog
+                assert rpm.macros["autochangelog"] == ["%nil"]
+
+            assert rpm.logfile is None
+            assert processor._prepare_rpm_in_process() is None
+
+        assert {name: stack for name, stack in rpm.macros.items() if stack} == macros_before
+
+    @pytest.mark.parametrize(
+        "specname", sorted(path.stem for path in TEST_SPECFILES_DIR.glob("*.spec"))
+    )
+    def test__get_rpmverflags_in_process_matches_command_line(self, specname, tmp_path):
+        rpm = pytest.importorskip("rpm")
+        if not hasattr(rpm, "spec"):
+            pytest.skip("RPM Python bindings not available")
+        if not which("rpm"):
+            pytest.skip("rpm command line tool not available")
+
+        specfile = tmp_path / f"{specname}.spec"
+        copy2(TEST_SPECFILES_DIR / f"{specname}.spec", specfile)
+        processor = PkgHistoryProcessor(specfile)
+
+        command_line = processor._get_rpmverflags(tmp_path, specname)
+
+        name_before = rpm.expandMacro("%{?name}")
+        autochangelog_before = rpm.expandMacro("%{?autochangelog:defined}")
+
+        with processor._rpm_session():
+            copy2(specfile, processor._workdir / specfile.name)
+            in_process = processor._get_rpmverflags(
+                processor._workdir, specname, rpmlog=processor._prepare_rpm_in_process()
+            )
+
+        assert command_line
+        assert in_process == command_line
+
+        # Neither macros from the spec file nor those set up for parsing linger.
+        assert rpm.expandMacro("%{?name}") == name_before
+        assert rpm.expandMacro("%{?autochangelog:defined}") == autochangelog_before
+
     @pytest.mark.parametrize(
         "testcase", ("without commit", "with commit", "all results", "locale set", "without repo")
     )
@@ -233,3 +551,77 @@ class TestPkgHistoryProcessor:
             assert top_entry.format().startswith(expected_date_blurb)
 
         assert all("error" not in entry for entry in changelog)
+
+    @pytest.mark.parametrize("bumped_parent", ("first", "second"))
+    def test_run_merge_partially_processed(self, bumped_parent, specfile, repo, processor):
+        """Process commits needed by one child even if another child doesn't need them."""
+        base_commit = repo[repo.head.target]
+
+        def commit_files(message, parents, files=None, tree=None):
+            if tree is None:
+                treebuilder = repo.TreeBuilder(base_commit.tree)
+                for name, content in (files or {}).items():
+                    treebuilder.insert(name, repo.create_blob(content), pygit2.GIT_FILEMODE_BLOB)
+                tree = treebuilder.write()
+            return repo[
+                repo.create_commit(
+                    None,
+                    repo.default_signature,
+                    repo.default_signature,
+                    message,
+                    tree,
+                    [parent.id for parent in parents],
+                )
+            ]
+
+        # The bumped branch needs neither the base commit's release number nor its changelog,
+        # the other branch needs both.
+        prepared_commit = commit_files("Prepare update", [base_commit])
+        bumped_commit = commit_files(
+            "Update to 2.0",
+            [prepared_commit],
+            {
+                specfile.name: self.version_re.sub("Version: 2.0", specfile.read_text()).encode(),
+                "changelog": b"* Thu Jan 01 1970 Jane Doe <jane.doe@example.com>\n- Boo\n",
+            },
+        )
+        other_commit = commit_files("Did something else!", [base_commit])
+
+        if bumped_parent == "first":
+            merge_parents = [bumped_commit, other_commit]
+        else:
+            merge_parents = [other_commit, bumped_commit]
+        merge_commit = commit_files("Merge", merge_parents, tree=bumped_commit.tree.id)
+        repo.head.set_target(merge_commit.id)
+
+        def _get_rpmverflags(path, name=None, **kwargs):
+            spectext = (Path(path) / f"{name}.spec").read_text()
+            return {
+                "epoch-version": self.version_re.search(spectext).group().split()[1],
+                "extraver": None,
+                "snapinfo": None,
+                "prerelease": False,
+                "base": 1,
+            }
+
+        with patch.object(processor, "_get_rpmverflags", side_effect=_get_rpmverflags):
+            res = processor.run(
+                merge_commit,
+                visitors=[processor.release_number_visitor, processor.changelog_visitor],
+                all_results=True,
+            )
+
+        assert prepared_commit not in res
+        assert res[base_commit]["release-number"] == 2
+        assert res[other_commit]["release-number"] == 3
+        assert res[bumped_commit]["release-number"] == 1
+        assert res[merge_commit]["release-number"] == 2
+
+        assert [entry["commit-id"] for entry in res[other_commit]["changelog"]] == [
+            other_commit.id,
+            base_commit.id,
+            base_commit.parents[0].id,
+        ]
+        assert [entry["commit-id"] for entry in res[merge_commit]["changelog"]] == [
+            bumped_commit.id
+        ]